@@ -1,29 +1,207 @@
+import asyncio
 import logging
 import os
+import random
 import time
+import zlib
+from collections import OrderedDict
 from textwrap import dedent
+from types import MappingProxyType
 
-from kubernetes import client, config, watch
+import aiohttp
+import orjson
+from kubernetes_asyncio import client, config, watch
 
 
 LAST_MODIFIED_LABEL = 'kubespresso.io/lastCoffeeGranted'
 EXPECTED_DURATION_LABEL = 'kubespresso.io/expectedDuration'
+# JSON pointer to the annotation ('/' is escaped as '~1', see RFC 6901)
+LAST_MODIFIED_PATH = (
+    '/metadata/annotations/' + LAST_MODIFIED_LABEL.replace('/', '~1')
+)
+JSON_PATCH_CONTENT_TYPE = 'application/json-patch+json'
+WATCH_TIMEOUT_SECONDS = 3600
+# A watch that ends without events this long after it was opened timed out
+# normally (there was just nothing to send), sooner than that it failed
+WATCH_MIN_HEALTHY_SECONDS = WATCH_TIMEOUT_SECONDS * 0.9
+COFFEE_INTERVAL_SECONDS = 86400  # 1 day
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 60  # seconds
+# Annotations can't be filtered on by the API server, so pods may also be
+# labeled to let it drop everything else before it reaches us
+LABEL_SELECTOR = os.environ.get('KUBESPRESSO_LABEL_SELECTOR')
+# Running the controller as a StatefulSet of N replicas with
+# `KUBESPRESSO_SHARD_COUNT` set to N splits the pods between them, each replica
+# handles the pods whose uid hashes to its ordinal. The ordinal comes from the
+# `apps.kubernetes.io/pod-index` label (passed by the downward API) or else
+# from the pod name. `KUBESPRESSO_SHARD` set to index/count overrides both.
+SHARD = os.environ.get('KUBESPRESSO_SHARD')
+SHARD_COUNT = os.environ.get('KUBESPRESSO_SHARD_COUNT')
+POD_INDEX = (
+    os.environ.get('KUBESPRESSO_POD_INDEX')
+    or os.environ.get('HOSTNAME', '').rpartition('-')[2]
+)
+EVENT_QUEUE_SIZE = 1024
+MAX_CONCURRENT_PATCHES = 6
+DEBOUNCE_MIN_DELAY = 0.1  # seconds
+DEBOUNCE_MAX_DELAY = 0.8  # seconds
+DEBOUNCE_MAX_WAIT = 5  # seconds
+DEBOUNCE_MAX_KEYS = 4096
+SEEN_EVENTS_MAX_SIZE = 4096
+GRANTED_PODS_MAX_SIZE = 4096
+PATCH_RATE = 10  # patches per second
+PATCH_BURST = 10
+
+# Created in `main`, once the event loop is running
+patch_semaphore = None
+coffee_debouncer = None
+patch_limiter = None
+# Shared by every API call so we reuse a single connection pool
+core_v1_api = None
+# Last resource version seen on the watch, so we can resume from it instead of
+# listing all the pods again. None means "start with a full list".
+resource_version = None
+# This controller's shard, set from `resolve_shard` in `main`
+shard_index, shard_count = 0, 1
+# LRU of the (uid, resourceVersion) of the events coffee_handler already saw
+seen_events = OrderedDict()
+# LRU of pod uid -> the `LAST_MODIFIED_LABEL` timestamp we last patched it with
+granted_pods = OrderedDict()
+
+
+DEFAULT_COLOR = '\x1b[0m'
+COLORS = MappingProxyType({
+    'red': '\x1b[31m',
+    'green': '\x1b[32m',
+    'yellow': '\x1b[33m',
+    'cyan': '\x1b[36m',
+})
+
+
+def colored(color, message):
+    """Small function to wrap a string around a color"""
+    return f'{COLORS[color]}{message}{DEFAULT_COLOR}'
+
+
+class Debouncer(object):
+    """Coalesce bursts of calls for the same key into a single call
+
+    Scheduling a key that already has a pending call cancels it and schedules
+    a new one with twice the delay (up to `max_delay`), so only the arguments
+    of the last call in a burst reach `callback`. A key never waits more than
+    `max_wait` since it was first scheduled, so a steady stream of calls can't
+    hold it back forever. The number of pending keys is capped to `max_keys`;
+    when it's exceeded, the least recently scheduled key is dispatched right
+    away.
+    """
 
+    def __init__(self, callback, min_delay, max_delay, max_wait, max_keys):
+        self.callback = callback
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.max_keys = max_keys
+        # key -> (timer, delay, first scheduled at, args)
+        self._pending = OrderedDict()
+        self._tasks = set()
+
+    def schedule(self, key, *args):
+        loop = asyncio.get_running_loop()
+        delay = self.min_delay
+        first_scheduled_at = loop.time()
+        if key in self._pending:
+            timer, delay, first_scheduled_at, _ = self._pending.pop(key)
+            timer.cancel()
+            delay = min(delay * 2, self.max_delay)
+        deadline = first_scheduled_at + self.max_wait
+        timer = loop.call_at(
+            min(loop.time() + delay, deadline), self._dispatch, key
+        )
+        self._pending[key] = (timer, delay, first_scheduled_at, args)
+        while len(self._pending) > self.max_keys:
+            oldest_key, pending = next(iter(self._pending.items()))
+            pending[0].cancel()
+            self._dispatch(oldest_key)
+
+    def _dispatch(self, key):
+        _, _, _, args = self._pending.pop(key)
+        task = asyncio.ensure_future(self._run(*args))
+        # Keep a reference so the task isn't garbage collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, *args):
+        try:
+            await self.callback(*args)
+        except Exception:
+            logging.exception(f'{self.callback.__name__} failed')
+
+
+class TokenBucket(object):
+    """Rate limit callers of `acquire` to `rate` per second
+
+    Up to `burst` callers get through right away after a quiet period, the ones
+    that follow wait for a token to be refilled.
+    """
 
-class Color(object):
-    DEFAULT = '\x1b[0m'
-    RED = '\x1b[31m'
-    GREEN = '\x1b[32m'
-    YELLOW = '\x1b[33m'
-    CYAN = '\x1b[36m'
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            elapsed = now - self._updated_at
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RawWatch(watch.Watch):
+    """`Watch` that doesn't deserialize events into API models
+
+    Handlers only look at a handful of metadata fields, so building a full
+    `V1Pod` for every event is wasted work. The `object` of every event is the
+    same JSON dict as its `raw_object`, parsed with `orjson` which is a lot
+    faster than the stdlib `json` the base class uses.
+
+    Like the base class, a `Status` sent instead of an event (e.g. the body of
+    a 5xx response, since the watch doesn't preload its content), ERROR events
+    and events missing their `type` or `object` are raised as an
+    `ApiException`. Lines that aren't JSON are logged and turned into None.
+    """
 
-    @classmethod
-    def colored(cls, color, message):
-        """Small function to wrap a string around a color"""
-        return getattr(cls, color.upper()) + message + cls.DEFAULT
+    def unmarshal_event(self, data, response_type):
+        try:
+            event = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            logging.warning(f'Ignoring a watch line that is not JSON: {data!r}')
+            return None
+        if 'object' not in event or 'type' not in event:
+            if 'code' in event:
+                raise client.rest.ApiException(
+                    status=event['code'],
+                    reason=f"{event.get('reason')}: {event.get('message')}"
+                )
+            raise client.rest.ApiException(
+                reason=f'Malformed watch event: {event}'
+            )
+        event['raw_object'] = event['object']
+        if event['type'] == 'ERROR':
+            status = event['raw_object']
+            raise client.rest.ApiException(
+                status=status.get('code'),
+                reason=f"{status.get('reason')}: {status.get('message')}"
+            )
+        return event
 
 
-def cluster_login():
+async def cluster_login():
     """Initialize kubeconfig so we can communicate with the API server
 
     Depands on where we're running from (local or from within the cluster),
@@ -34,7 +212,7 @@ def cluster_login():
         config.load_incluster_config()
     else:
         logging.debug('Running outside of a cluster')
-        config.load_kube_config()
+        await config.load_kube_config()
 
 
 def setup_logger(level=logging.INFO):
@@ -42,14 +220,143 @@ def setup_logger(level=logging.INFO):
     logging.getLogger().setLevel(level)
 
 
-def process_stream(stream, handlers):
-    logging.info('Start processing event stream')
-    for event in stream:
+async def worker(queue, handler):
+    """Consume events from `queue` and feed them to `handler` forever
+
+    Events are handled one at a time in the order they were read, so a handler
+    never sees two events of the same pod out of order. An exception raised by
+    the handler is logged and the worker moves on to the next event, so one
+    bad event can't stall the handler for good.
+    """
+    while True:
+        event, now = await queue.get()
+        try:
+            await handler(event, now)
+        except Exception:
+            logging.exception(f'{handler.__name__} failed to handle event')
+        finally:
+            queue.task_done()
+
+
+def start_workers(handlers_by_type):
+    """Create a queue per handler with a worker consuming it
+
+    :param dict handlers_by_type: Handlers to run for every event type. A
+                                  handler registered under several types gets
+                                  a single queue.
+    :rtype: tuple(dict, list)
+    :returns: A tuple with the queues to put events of every type on and the
+              worker tasks consuming them.
+    """
+    queue_by_handler = {}
+    tasks = []
+    for handlers in handlers_by_type.values():
         for handler in handlers:
-            handler(event)
+            if handler in queue_by_handler:
+                continue
+            queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+            queue_by_handler[handler] = queue
+            tasks.append(asyncio.create_task(worker(queue, handler)))
+    queues_by_type = {
+        event_type: [queue_by_handler[handler] for handler in handlers]
+        for event_type, handlers in handlers_by_type.items()
+    }
+    return queues_by_type, tasks
+
+
+async def process_stream(stream, queues_by_type):
+    """Fan out every event of the stream to the queues of its type
+
+    Handlers run in their own workers, so reading the next event off the watch
+    only waits for room in the queues, not for the handlers to finish. The
+    current time is taken once per event and handed to every handler along
+    with it.
+
+    Events for pods of other shards are dropped. The resource version of
+    every event (including the ones no handler is registered for, like
+    bookmarks, or of other shards) is kept in `resource_version`.
+
+    :rtype: int
+    :returns: The number of events read off the stream.
+    """
+    global resource_version
+    logging.info('Start processing event stream')
+    received = 0
+    async for event in stream:
+        if event is None:  # Not a JSON line, see `RawWatch.unmarshal_event`
+            continue
+        received += 1
+        raw_object = event['raw_object']
+        resource_version = raw_object['metadata']['resourceVersion']
+        queues = queues_by_type.get(event['type'])
+        if not queues or not pod_in_shard(raw_object):
+            continue
+        item = (event, int(time.time()))
+        await asyncio.gather(*(queue.put(item) for queue in queues))
+    return received
+
+
+def pod_in_shard(pod) -> bool:
+    """Tell if the given pod is handled by this shard of the controller
+
+    The hash has to be the same across processes, so the builtin `hash` (which
+    is randomized per process) can't be used.
+
+    :param dict pod: JSON representation of the pod.
+    :rtype: bool
+    """
+    if shard_count == 1:
+        return True
+    uid = pod['metadata']['uid']
+    return zlib.crc32(uid.encode()) % shard_count == shard_index
 
 
-def logger_handler(event):
+def parse_shard(shard) -> (int, int):
+    """Parse a shard given as `index/count`, e.g. `0/3`
+
+    :rtype: tuple(int, int)
+    :returns: The index and the count of the shard.
+    :raises ValueError: If the shard isn't a valid `index/count`.
+    """
+    error = ValueError(
+        f'Invalid shard {shard!r}, it must be index/count with the index '
+        f'between 0 and count - 1 (e.g. 0/3)'
+    )
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise error from None
+    if not 0 <= index < count:
+        raise error
+    return index, count
+
+
+def resolve_shard(shard, shard_count, pod_index) -> (int, int):
+    """Tell which shard this controller handles
+
+    :param str shard: Explicit `index/count` shard, if any. It wins over the
+                      other two.
+    :param str shard_count: Number of shards, if the controller is sharded.
+    :param str pod_index: Ordinal of this controller's StatefulSet pod, used
+                          as the index when `shard_count` is given.
+    :rtype: tuple(int, int)
+    :returns: The index and the count of the shard.
+    :raises ValueError: If the shard can't be made out of the arguments.
+    """
+    if shard:
+        return parse_shard(shard)
+    if not shard_count:
+        return 0, 1
+    if not pod_index.isdigit():
+        raise ValueError(
+            f'Unknown StatefulSet ordinal {pod_index!r} for '
+            f'{shard_count} shards, set KUBESPRESSO_POD_INDEX or '
+            f'KUBESPRESSO_SHARD'
+        )
+    return parse_shard(f'{pod_index}/{shard_count}')
+
+
+async def logger_handler(event, now):
     """Show all the events we see during the processing loop
 
     This handler exists for debugging. It just prints every event it encounters
@@ -58,73 +365,127 @@ def logger_handler(event):
     :param Event event: Object representing an event. This object is generated
                         by the `unmarshal_event` method of the `Watch` object.
                         It's defined under `kubernetes.base.watch`.
+    :param int now: Unix timestamp of when the event was read off the stream.
     """
     # event can be: ADDED, MODIFIED, DELETED
     obj_name = event['raw_object']['metadata']['name']
     event_type = event['type']
     metadata = event['raw_object']['metadata']
     logging.info(f'handling event {event_type} for {obj_name}')
-    logging.debug(f'metadata for {obj_name}: {metadata}')
+    logging.debug('metadata for %s: %s', obj_name, metadata)
 
 
-def coffee_handler(event):
+async def coffee_handler(event, now):
     """Process an event and make coffee if needed
 
     :param Event event: Object representing an event. This object is generated
                     by the `unmarshal_event` method of the `Watch` object.
                     It's defined under `kubernetes.base.watch`.
+    :param int now: Unix timestamp of when the event was read off the stream.
     """
-    ok, reason = event_deserves_coffee(event)
+    if event_already_seen(event):
+        logging.debug('Skipping an event we already handled')
+        return
+    ok, reason = event_deserves_coffee(event, now)
     if not ok:
-        logging.info(Color.colored('yellow', f'Sorry, {reason}'))
+        logging.info(colored('yellow', f'Sorry, {reason}'))
         return
-    ok, reason = annotate_pod(event)
+    obj_meta = event['raw_object']['metadata']
+    coffee_debouncer.schedule(
+        f"{obj_meta['namespace']}/{obj_meta['name']}", event, now
+    )
+
+
+def _lru_put(cache, key, value, max_size):
+    """Set `key` as the most recently used entry of the `cache` LRU
+
+    The least recently used entry is dropped once `cache` holds more than
+    `max_size` entries.
+
+    :param OrderedDict cache: The LRU, its oldest entry first.
+    """
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def event_already_seen(event) -> bool:
+    """Remember the event and tell if it was already seen before
+
+    The watch may deliver the same version of a pod more than once, e.g. after
+    a reconnect. Handling it again would only end up in a conflict.
+
+    :rtype: bool
+    :returns: True if an event for the same version of the object was seen.
+    """
+    metadata = event['raw_object']['metadata']
+    key = (metadata['uid'], metadata['resourceVersion'])
+    seen = key in seen_events
+    _lru_put(seen_events, key, True, SEEN_EVENTS_MAX_SIZE)
+    return seen
+
+
+async def grant_coffee(event, now):
+    """Annotate the pod under the event and make the coffee it deserves
+
+    This is called by `coffee_debouncer` with the last event of a burst, so a
+    pod that's modified many times in a row is only patched once.
+    """
+    async with patch_semaphore:
+        ok, reason = await annotate_pod(event, now)
     if not ok:
-        logging.info(Color.colored('yellow', f'Sorry, {reason}'))
+        logging.info(colored('yellow', f'Sorry, {reason}'))
         return
-    logging.info(Color.colored('green', f'Good news! you\'re getting a coffee'))
-    make_coffee()
+    logging.info(colored('green', f'Good news! you\'re getting a coffee'))
+    await make_coffee()
 
 
-def annotate_pod(event) -> (bool, str):
+async def annotate_pod(event, now) -> (bool, str):
     """Annotate the pod under the event
 
     :rtype: tuple(bool, str)
     :returns: A tuple that indicates if the pod was annotated succesfully or not
              and a string representation of the outcome.
     """
-    obj = event['object']
-    patch = generate_annotation_patch(event)
-    obj_meta = obj.metadata
-    patch_applied = apply_patch_on_pod(obj_meta.name, obj_meta.namespace, patch)
+    obj_meta = event['raw_object']['metadata']
+    uid = obj_meta['uid']
+    # The event may predate our own patch, in which case the annotation on the
+    # server is already current and patching again would only conflict
+    if now - granted_pods.get(uid, 0) < COFFEE_INTERVAL_SECONDS:
+        return False, 'you already received a coffee today'
+    patch = generate_annotation_patch(event, now)
+    patch_applied = await apply_patch_on_pod(
+        obj_meta['name'], obj_meta['namespace'], patch
+    )
     if patch_applied:
+        _lru_put(granted_pods, uid, now, GRANTED_PODS_MAX_SIZE)
         return True, 'You definitely deserve a coffee!'
     return False, 'There is a newer version of the object. Please wait'
 
 
-def event_deserves_coffee(event):
-    obj = event['object']
-    if event['type'] not in ('ADDED', 'MODIFIED'):
-            return False, 'coffee is granted only on ADDED or MODIFIED Pods'
-    if obj.kind != 'Pod':
+def event_deserves_coffee(event, now):
+    # Cheapest checks first, most events are rejected before the last one.
+    # The event type is already taken care of by `HANDLERS_BY_TYPE`.
+    raw_object = event['raw_object']
+    if raw_object['kind'] != 'Pod':
         return False, 'coffee is granted only for Pod objects'
-    expected_duration = int(
-        extract_field_from_event_annotations(event, EXPECTED_DURATION_LABEL)
-        or 0
-    )
+    annotations = raw_object['metadata'].get('annotations') or {}
+    expected_duration = int(annotations.get(EXPECTED_DURATION_LABEL) or 0)
     if expected_duration < 60:
         return False, "Pod's expected duration is less than 60"
-    if seconds_since_last_modification(event) < 86400:  # 1 day in seconds
+    if seconds_since_last_modification(event, now) < COFFEE_INTERVAL_SECONDS:
         return False, 'you already received a coffee today'
     return True, 'you deserve a coffee'
 
 
-def seconds_since_last_modification(event) -> int:
+def seconds_since_last_modification(event, now) -> int:
     """Given an event, return the time passed since the last time we touched it
 
     :param Event event: Object representing an event. This object is generated
                         by the `unmarshal_event` method of the `Watch` object.
                         It's defined under `kubernetes.base.watch`.
+    :param int now: Unix timestamp to measure the time passed against.
 
     :rtype: int
     :returns: Seconds since the last time we touched this event
@@ -132,20 +493,20 @@ def seconds_since_last_modification(event) -> int:
     last_modified = int(
         extract_field_from_event_annotations(event, LAST_MODIFIED_LABEL) or 0
     )
-    return int(time.time()) - last_modified
+    return now - last_modified
 
 
-def make_coffee():
+async def make_coffee():
     """Do an API call to the coffee machine and make a coffee
     """
     # ... some coffe machine specific code goes here ....
-    logging.info(Color.colored('cyan', 'Hold on... I\'m boiling the water...'))
-    time.sleep(3)
-    logging.info(Color.colored('cyan', 'Adding sugar...'))
-    time.sleep(2)
-    logging.info(Color.colored('cyan', 'Voila!'))
-    time.sleep(0.2)
-    logging.info(Color.colored(
+    logging.info(colored('cyan', 'Hold on... I\'m boiling the water...'))
+    await asyncio.sleep(3)
+    logging.info(colored('cyan', 'Adding sugar...'))
+    await asyncio.sleep(2)
+    logging.info(colored('cyan', 'Voila!'))
+    await asyncio.sleep(0.2)
+    logging.info(colored(
         'cyan',
         """
                {
@@ -166,48 +527,67 @@ def make_coffee():
     ))
 
 
-def generate_annotation_patch(event) -> dict:
+def generate_annotation_patch(event, now) -> list:
     """Generate `LAST_MODIFIED_LABEL` annotation patch
 
     In order to keep track of events we already processed, we set an
     annotation with a timestamp of the last time we processed this object. This
-    method generates a patch object that can be applied via the API.
+    method generates a JSON patch that can be applied via the API. Setting the
+    resource version makes the API server reject the patch with a conflict if
+    the pod changed since the event.
 
     :param Event event: Object representing an event. This object is generated
                         by the `unmarshal_event` method of the `Watch` object.
                         It's defined under `kubernetes.base.watch`.
-    :rtype: dict
-    :returns: dict with a patch to be applied on the pod.
-    """
-    event_object = event['object']
-    resource_version = event_object.metadata.resource_version or '0'
-    now = str(int(time.time()))
-    object_meta = client.V1ObjectMeta(
-        annotations={LAST_MODIFIED_LABEL: now},
-        resource_version=resource_version
-    )
-    # obj_name = event_object.metadata.name
-    # ns = event_object.metadata.namespace
-    return {'metadata': object_meta}
-
-
-def apply_patch_on_pod(object_name:str , namespace: str, patch: object) -> bool:
-    """Safely patch the given `object_name` with the provided object (`body`)
+    :param int now: Unix timestamp to set in the annotation.
+    :rtype: list
+    :returns: list of JSON patch operations to be applied on the pod.
+    """
+    metadata = event['raw_object']['metadata']
+    resource_version = metadata.get('resourceVersion') or '0'
+    if metadata.get('annotations'):
+        annotation_op = {
+            'op': 'add', 'path': LAST_MODIFIED_PATH, 'value': str(now)
+        }
+    else:
+        # `add` needs the parent object to exist, so create it along the way
+        annotation_op = {
+            'op': 'add',
+            'path': '/metadata/annotations',
+            'value': {LAST_MODIFIED_LABEL: str(now)}
+        }
+    return [
+        {
+            'op': 'replace',
+            'path': '/metadata/resourceVersion',
+            'value': resource_version
+        },
+        annotation_op,
+    ]
+
+
+async def apply_patch_on_pod(object_name:str , namespace: str, patch: list) -> bool:
+    """Safely patch the given `object_name` with the provided JSON patch
 
     :rtype: bool
     :returns: True if the patch was applied successfully and False in case of
               a conflict.
     """
-    core_v1_api = client.CoreV1Api()
+    await patch_limiter.acquire()
     try:
-        core_v1_api.patch_namespaced_pod(object_name, namespace, patch)
-        logging.info(Color.colored(
+        await core_v1_api.patch_namespaced_pod(
+            object_name,
+            namespace,
+            patch,
+            _content_type=JSON_PATCH_CONTENT_TYPE
+        )
+        logging.info(colored(
             'green', f'Patched {object_name}')
         )
         return True
     except client.rest.ApiException as api_exception:
         if api_exception.reason == 'Conflict':
-            logging.info(Color.colored(
+            logging.info(colored(
                 'red', 'There is a newer version of the object')
             )
             return False
@@ -223,21 +603,100 @@ def extract_field_from_event_annotations(event, annotation) -> str:
     :rtype: str
     :returns: The requested annotation or an empty string if it doesn't exist.
     """
-    annotations = event['object'].metadata.annotations
+    annotations = event['raw_object']['metadata'].get('annotations')
     if annotations:
         return annotations.get(annotation, '')
     return ''
 
 
-def main():
+HANDLERS_BY_TYPE = {
+    'ADDED': [logger_handler, coffee_handler],
+    'MODIFIED': [logger_handler, coffee_handler],
+    'DELETED': [logger_handler],
+}
+
+
+async def watch_pods(queues_by_type):
+    """Keep watching pods and feed their events to the handler queues
+
+    The watch is reopened whenever it ends: right away after the timeout, or
+    after an exponential backoff with jitter if it failed or was closed well
+    before the timeout without sending a single event, so a struggling API
+    server isn't hammered with reconnects. The backoff only goes back to its
+    minimum once a watch has sent some events or lasted until the timeout.
+    """
+    global resource_version
+    loop = asyncio.get_running_loop()
+    backoff = RECONNECT_MIN_DELAY
+    while True:
+        opened_at = loop.time()
+        try:
+            async with RawWatch() as w:
+                stream = w.stream(
+                    core_v1_api.list_pod_for_all_namespaces,
+                    label_selector=LABEL_SELECTOR,
+                    resource_version=resource_version,
+                    allow_watch_bookmarks=True,
+                    timeout_seconds=WATCH_TIMEOUT_SECONDS
+                )
+                received = await process_stream(stream, queues_by_type)
+            lasted = loop.time() - opened_at
+            if received or lasted >= WATCH_MIN_HEALTHY_SECONDS:
+                backoff = RECONNECT_MIN_DELAY
+                continue
+            logging.warning(colored(
+                'red',
+                f'The watch was closed after {lasted:.0f} seconds without '
+                f'sending any event'
+            ))
+        except client.rest.ApiException as api_exception:
+            if api_exception.status == 410:  # Gone
+                logging.info(
+                    'Resource version is too old, listing all pods again'
+                )
+                resource_version = None
+            else:
+                logging.warning(colored(
+                    'red',
+                    f'Watch failed: {api_exception.status} '
+                    f'{api_exception.reason}'
+                ))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logging.warning(colored(
+                'red', f'Lost connection to the API server: {error!r}'
+            ))
+        delay = backoff + random.random()
+        logging.info(f'Reconnecting in {delay:.1f} seconds')
+        await asyncio.sleep(delay)
+        backoff = min(backoff * 2, RECONNECT_MAX_DELAY)
+
+
+async def main():
+    global patch_semaphore, coffee_debouncer, patch_limiter, core_v1_api
+    global shard_index, shard_count
     setup_logger(logging.INFO)
-    cluster_login()
-    core_v1_api = client.CoreV1Api()
-    stream = watch.Watch().stream(core_v1_api.list_pod_for_all_namespaces)
-    event_handlers = [logger_handler, coffee_handler]
-    while True:  # In case a timeout will occur during stream processing
-        process_stream(stream, event_handlers)
+    shard_index, shard_count = resolve_shard(SHARD, SHARD_COUNT, POD_INDEX)
+    logging.info(f'Handling shard {shard_index}/{shard_count}')
+    await cluster_login()
+    patch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PATCHES)
+    patch_limiter = TokenBucket(PATCH_RATE, PATCH_BURST)
+    coffee_debouncer = Debouncer(
+        grant_coffee,
+        DEBOUNCE_MIN_DELAY,
+        DEBOUNCE_MAX_DELAY,
+        DEBOUNCE_MAX_WAIT,
+        DEBOUNCE_MAX_KEYS
+    )
+    queues_by_type, workers = start_workers(HANDLERS_BY_TYPE)
+    try:
+        async with client.ApiClient() as api_client:
+            core_v1_api = client.CoreV1Api(api_client)
+            await watch_pods(queues_by_type)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
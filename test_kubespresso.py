@@ -0,0 +1,366 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import kubespresso
+
+
+class StopWatching(Exception):
+    pass
+
+
+class FakeResponse(object):
+    """Streaming response of a watch call, one JSON line per event"""
+
+    def __init__(self, lines):
+        self._lines = [line.encode() + b'\n' for line in lines]
+        self.content = self
+
+    async def readline(self):
+        if self._lines:
+            return self._lines.pop(0)
+        return b''
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def status_line(code):
+    return json.dumps({
+        'kind': 'Status',
+        'apiVersion': 'v1',
+        'status': 'Failure',
+        'reason': 'InternalError' if code >= 500 else 'TooManyRequests',
+        'message': 'try again later',
+        'code': code,
+    })
+
+
+def event_line(resource_version):
+    return json.dumps({
+        'type': 'ADDED',
+        'object': {
+            'kind': 'Pod',
+            'metadata': {
+                'name': 'sleeper',
+                'namespace': 'kubespresso',
+                'uid': 'some-uid',
+                'resourceVersion': resource_version,
+            },
+        },
+    })
+
+
+def watch_pods_until_sleeps(monkeypatch, responses, sleeps, watch_duration=0):
+    """Run `watch_pods` against `responses` and return the backoff delays
+
+    Every watch call gets the next list of lines from `responses` and takes
+    `watch_duration` seconds on the loop clock. It stops after `sleeps`
+    reconnect delays.
+    """
+    delays = []
+    responses = list(responses)
+    clock = [0]
+
+    async def list_pod_for_all_namespaces(**kwargs):
+        clock[0] += watch_duration
+        return FakeResponse(responses.pop(0))
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        clock[0] += delay
+        if len(delays) == sleeps:
+            raise StopWatching()
+
+    async def watch_pods():
+        loop = asyncio.get_running_loop()
+        monkeypatch.setattr(loop, 'time', lambda: clock[0])
+        await kubespresso.watch_pods({})
+
+    monkeypatch.setattr(kubespresso, 'core_v1_api', SimpleNamespace(
+        list_pod_for_all_namespaces=list_pod_for_all_namespaces
+    ))
+    monkeypatch.setattr(kubespresso, 'resource_version', None)
+    monkeypatch.setattr(kubespresso.random, 'random', lambda: 0)
+    monkeypatch.setattr(kubespresso.asyncio, 'sleep', fake_sleep)
+    with pytest.raises(StopWatching):
+        asyncio.run(watch_pods())
+    return delays
+
+
+@pytest.mark.parametrize('code', [500, 503, 429])
+def test_watch_pods_backs_off_on_server_errors(monkeypatch, code):
+    delays = watch_pods_until_sleeps(
+        monkeypatch, [[status_line(code)]] * 3, sleeps=3
+    )
+    assert delays == [1, 2, 4]
+
+
+def test_watch_pods_backs_off_when_the_watch_is_closed_early(monkeypatch):
+    delays = watch_pods_until_sleeps(
+        monkeypatch, [[]] * 3, sleeps=3, watch_duration=5
+    )
+    assert delays == [1, 2, 4]
+
+
+def test_watch_pods_reconnects_right_away_after_an_empty_timeout(monkeypatch):
+    delays = watch_pods_until_sleeps(
+        monkeypatch,
+        [[status_line(500)], [status_line(500)], [], [], [status_line(500)]],
+        sleeps=3,
+        watch_duration=kubespresso.WATCH_TIMEOUT_SECONDS
+    )
+    # The quiet watches that lasted until the timeout reset the backoff
+    assert delays == [1, 2, 1]
+
+
+def test_watch_pods_resets_backoff_after_receiving_events(monkeypatch):
+    delays = watch_pods_until_sleeps(
+        monkeypatch,
+        [
+            [status_line(500)],
+            [status_line(500)],
+            [event_line('42')],
+            [status_line(500)],
+        ],
+        sleeps=3
+    )
+    assert delays == [1, 2, 1]
+    assert kubespresso.resource_version == '42'
+
+
+def run_debouncer(scenario, min_delay=0.01, max_delay=0.04, max_wait=1,
+                  max_keys=10):
+    """Run `scenario(debouncer, started_at)` and return the dispatched calls
+
+    Each call is recorded as `(seconds since start, key, arg)`.
+    """
+    calls = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+
+        async def callback(key, arg):
+            calls.append((loop.time() - started_at, key, arg))
+
+        debouncer = kubespresso.Debouncer(
+            callback, min_delay, max_delay, max_wait, max_keys
+        )
+        await scenario(debouncer, started_at)
+
+    asyncio.run(main())
+    return calls
+
+
+def test_debouncer_dispatches_a_single_call_after_min_delay():
+    async def scenario(debouncer, started_at):
+        debouncer.schedule('pod', 'pod', 1)
+        await asyncio.sleep(0.005)
+        assert debouncer._pending
+        await asyncio.sleep(0.1)
+
+    [(at, key, arg)] = run_debouncer(scenario)
+    assert (key, arg) == ('pod', 1)
+    assert 0.01 <= at < 0.04
+
+
+def test_debouncer_doubles_the_delay_of_a_burst_up_to_max_delay():
+    async def scenario(debouncer, started_at):
+        # 0.01 -> 0.02 -> 0.04 -> 0.04 (capped) -> 0.04
+        for arg in range(5):
+            debouncer.schedule('pod', 'pod', arg)
+        await asyncio.sleep(0.03)
+        assert debouncer._pending
+        await asyncio.sleep(0.2)
+
+    [(at, key, arg)] = run_debouncer(scenario)
+    assert arg == 4
+    # 0.16 if the delay kept doubling
+    assert 0.04 <= at < 0.1
+
+
+def test_debouncer_dispatches_a_steady_stream_every_max_wait():
+    scheduled = []
+
+    async def scenario(debouncer, started_at):
+        loop = asyncio.get_running_loop()
+        for arg in range(50):  # a call every ~10ms for ~0.5s
+            debouncer.schedule('pod', 'pod', arg)
+            scheduled.append((loop.time() - started_at, arg))
+            await asyncio.sleep(0.009)
+        await asyncio.sleep(0.1)
+
+    calls = run_debouncer(
+        scenario, min_delay=0.03, max_delay=0.12, max_wait=0.2
+    )
+    # Without a cap on the total wait nothing would be dispatched until the
+    # stream stops
+    assert [round(at, 1) for at, _, _ in calls[:2]] == [0.2, 0.4]
+    # Every dispatch carries the args of the last call before it
+    for at, _, arg in calls:
+        last_arg = max(a for scheduled_at, a in scheduled if scheduled_at < at)
+        assert arg == last_arg
+    assert calls[-1][2] == scheduled[-1][1]
+
+
+def test_debouncer_dispatches_the_oldest_key_beyond_max_keys():
+    async def scenario(debouncer, started_at):
+        for key in ('a', 'b', 'c'):
+            debouncer.schedule(key, key, 1)
+        await asyncio.sleep(0)
+        assert list(debouncer._pending) == ['b', 'c']
+
+    calls = run_debouncer(scenario, min_delay=10, max_delay=10, max_keys=2)
+    assert [key for _, key, _ in calls] == ['a']
+
+
+def pod_event(annotations=None, resource_version='42'):
+    metadata = {
+        'name': 'sleeper',
+        'namespace': 'kubespresso',
+        'uid': 'some-uid',
+        'resourceVersion': resource_version,
+    }
+    if annotations is not None:
+        metadata['annotations'] = annotations
+    return {
+        'type': 'MODIFIED',
+        'raw_object': {'kind': 'Pod', 'metadata': metadata},
+    }
+
+
+def test_generate_annotation_patch_adds_the_annotation_next_to_others():
+    event = pod_event({'kubespresso.io/expectedDuration': '120'})
+    patch = kubespresso.generate_annotation_patch(event, 1700000000)
+    assert patch == [
+        {
+            'op': 'replace',
+            'path': '/metadata/resourceVersion',
+            'value': '42',
+        },
+        {
+            'op': 'add',
+            'path': '/metadata/annotations/kubespresso.io~1lastCoffeeGranted',
+            'value': '1700000000',
+        },
+    ]
+
+
+@pytest.mark.parametrize('annotations', [None, {}])
+def test_generate_annotation_patch_creates_missing_annotations(annotations):
+    event = pod_event(annotations)
+    patch = kubespresso.generate_annotation_patch(event, 1700000000)
+    assert patch == [
+        {
+            'op': 'replace',
+            'path': '/metadata/resourceVersion',
+            'value': '42',
+        },
+        {
+            'op': 'add',
+            'path': '/metadata/annotations',
+            'value': {'kubespresso.io/lastCoffeeGranted': '1700000000'},
+        },
+    ]
+
+
+def test_token_bucket_lets_a_burst_through_then_waits_for_refills(
+        monkeypatch):
+    clock = [1000.0]
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+        clock[0] += delay
+
+    monkeypatch.setattr(kubespresso.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(kubespresso.asyncio, 'sleep', fake_sleep)
+    rate, burst = kubespresso.PATCH_RATE, kubespresso.PATCH_BURST
+
+    async def acquire_many(bucket, count):
+        for _ in range(count):
+            await bucket.acquire()
+
+    bucket = kubespresso.TokenBucket(rate, burst)
+    asyncio.run(acquire_many(bucket, burst))
+    assert sleeps == []
+
+    asyncio.run(acquire_many(bucket, 1))
+    assert sleeps == [pytest.approx(1 / rate)]
+
+    # A long quiet period refills up to `burst` tokens, not more
+    sleeps.clear()
+    clock[0] += 3600
+    asyncio.run(acquire_many(bucket, burst))
+    assert sleeps == []
+    asyncio.run(acquire_many(bucket, 1))
+    assert sleeps == [pytest.approx(1 / rate)]
+
+
+def test_lru_put_evicts_the_least_recently_used_key():
+    cache = kubespresso.OrderedDict()
+    kubespresso._lru_put(cache, 'a', 1, max_size=2)
+    kubespresso._lru_put(cache, 'b', 2, max_size=2)
+    kubespresso._lru_put(cache, 'a', 3, max_size=2)
+    kubespresso._lru_put(cache, 'c', 4, max_size=2)
+    assert list(cache.items()) == [('a', 3), ('c', 4)]
+
+
+@pytest.mark.parametrize('shard', ['2', 'a/b', '2/2', '0/0', '-1/2', '0/1/2'])
+def test_parse_shard_rejects_invalid_shards(shard):
+    with pytest.raises(ValueError, match='Invalid shard'):
+        kubespresso.parse_shard(shard)
+
+
+@pytest.mark.parametrize('shard, expected', [
+    ('0/1', (0, 1)),
+    ('2/3', (2, 3)),
+])
+def test_parse_shard(shard, expected):
+    assert kubespresso.parse_shard(shard) == expected
+
+
+@pytest.mark.parametrize('shard, shard_count, pod_index, expected', [
+    (None, None, '', (0, 1)),
+    (None, None, 'abc12', (0, 1)),
+    (None, '3', '2', (2, 3)),
+    ('0/2', '3', '2', (0, 2)),
+])
+def test_resolve_shard(shard, shard_count, pod_index, expected):
+    assert kubespresso.resolve_shard(shard, shard_count, pod_index) == expected
+
+
+@pytest.mark.parametrize('pod_index, error', [
+    ('abc12', 'Unknown StatefulSet ordinal'),
+    ('', 'Unknown StatefulSet ordinal'),
+    ('3', 'Invalid shard'),
+])
+def test_resolve_shard_rejects_invalid_ordinals(pod_index, error):
+    with pytest.raises(ValueError, match=error):
+        kubespresso.resolve_shard(None, '3', pod_index)
+
+
+def test_pod_in_shard_splits_pods_by_uid_crc32(monkeypatch):
+    # crc32 and not the builtin `hash`, so every replica agrees on the split
+    # whatever its PYTHONHASHSEED
+    expected_shards = {
+        '6f1c2b9e-0d4a-4c35-9a83-2f1e6b7c8d90': 2,
+        'a3e5c7d1-8b2f-4e6a-9c0d-1f2e3a4b5c6d': 1,
+        '0b9d8c7e-6f5a-4b3c-2d1e-0f9e8d7c6b5a': 0,
+        'd4c3b2a1-1234-5678-9abc-def012345678': 1,
+    }
+    monkeypatch.setattr(kubespresso, 'shard_count', 3)
+    for uid, expected_shard in expected_shards.items():
+        pod = {'metadata': {'uid': uid}}
+        shards = []
+        for index in range(3):
+            monkeypatch.setattr(kubespresso, 'shard_index', index)
+            if kubespresso.pod_in_shard(pod):
+                shards.append(index)
+        assert shards == [expected_shard]